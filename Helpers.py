@@ -7,60 +7,127 @@ gym_OptClang
 """
 import tensorflow as tf
 import numpy as np
-import matplotlib
-# do not use x-server
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import gym, gym_OptClang
-import random, threading, queue, operator, os, sys, re
-from operator import itemgetter
-from random import shuffle
-import random
-from colorama import Fore, Style
-from datetime import datetime
-from sklearn.preprocessing import StandardScaler
-import time
+import random, threading, os, sys
+import functools
+from colorama import Style
 import io
-from time import gmtime, strftime
-import argparse
-import pytz
-import PPPO
-import Helpers as hp
 import json
 
-def InitSharedStorage():
+def InitSharedStorage(N_WORKER):
     """
     Shared vars
     """
     '''
-    All the methods in Python threading.events are atomic operations.
-    https://docs.python.org/3/library/threading.html
+    Workers and the PPO updater meet at the barrier twice for every update:
+    1. all workers put their batch of data, the updater starts to update.
+    2. the updater finished, all workers start to collect again.
+    https://docs.python.org/3/library/threading.html#barrier-objects
     '''
-    SharedEvents = {}
-    SharedEvents['update'] = threading.Event()
-    SharedEvents['update'].clear()            # not update now
-    SharedEvents['collect'] = threading.Event()
-    SharedEvents['collect'].set()             # start to collect
-    # prevent race condition with 3 locks
+    Barrier = threading.Barrier(N_WORKER + 1)
+    # prevent race condition with lock
     Locks = {}
-    Locks['queue'] = threading.Lock()
-    Locks['counter'] = threading.Lock()
     Locks['plot_epi'] = threading.Lock()
     # counters for synchrnization
     SharedCounters = {}
     SharedCounters['ep'] = 0
-    SharedCounters['update_counter'] = 0
     # a global dict to access everything
     SharedStorage = {}
-    SharedStorage['Events'] = SharedEvents
+    SharedStorage['Barrier'] = Barrier
     SharedStorage['Locks'] = Locks
     SharedStorage['Counters'] = SharedCounters
     # coordinator for threads
     SharedStorage['Coordinator'] = tf.train.Coordinator()
-    # workers putting data in this queue
-    SharedStorage['DataQueue'] = queue.Queue()
+    # each worker puts data in its own buffer: state, action(pass index < 256), discounted reward
+    SharedStorage['DataBuffers'] = [BatchBuffer(dtypes=(np.float32, np.uint8, np.float32))
+            for _ in range(N_WORKER)]
     return SharedStorage
 
+class BatchBuffer(object):
+    """
+    Preallocated storage for the transitions collected by one worker.
+    State, action and discounted reward are kept in separate contiguous arrays,
+    so the updater can feed them to tensorflow without slicing or copying.
+    The worker appends a whole batch at once and the updater drains all of them at once.
+    There is no lock: only one worker puts and only the updater drains,
+    and the barrier in SharedStorage guarantees that put() and drain() never overlap.
+    dtypes: dtype of each array, in the same order as put().
+    """
+    def __init__(self, dtypes, capacity=1024):
+        self.Dtypes = dtypes
+        self.Capacity = capacity
+        self.Storage = None
+        self.Size = 0
+
+    def _alloc(self, capacity, arrays):
+        return [np.empty((capacity, array.shape[1]), dtype=dtype)
+                for array, dtype in zip(arrays, self.Dtypes)]
+
+    def put(self, *arrays):
+        """
+        arrays: 2-D np.arrays with the same number of rows, one transition per row.
+        ex. put(vstack_s, vstack_a, vstack_r)
+        """
+        count = arrays[0].shape[0]
+        if self.Storage is None:
+            self.Storage = self._alloc(self.Capacity, arrays)
+        if self.Size + count > self.Storage[0].shape[0]:
+            # grow and keep the rows which are not drained yet
+            NewCapacity = max(2 * self.Storage[0].shape[0], self.Size + count)
+            NewStorage = self._alloc(NewCapacity, arrays)
+            for new, old in zip(NewStorage, self.Storage):
+                new[:self.Size] = old[:self.Size]
+            self.Storage = NewStorage
+        for store, array in zip(self.Storage, arrays):
+            store[self.Size:self.Size + count] = array
+        self.Size += count
+
+    def drain(self):
+        """
+        return all the rows put since the last drain as a tuple of 2-D np.arrays,
+        in the same order as put().
+        The returned arrays are views which stay valid until the next put().
+        """
+        data = tuple(store[:self.Size] for store in self.Storage)
+        self.Size = 0
+        return data
+
+class TransitionBuffer(object):
+    """
+    Preallocated storage for the transitions of one worker which are not discounted yet.
+    Features, actions and rewards are written row by row behind a cursor,
+    and Rows keeps the row indices of each function for calcDiscountedRewards().
+    """
+    def __init__(self, S_DIM, capacity=256):
+        self.S = np.empty((capacity, S_DIM), dtype=np.float32)
+        self.A = np.empty((capacity, 1), dtype=np.uint8)
+        self.R = np.empty((capacity, 1), dtype=np.float32)
+        self.Rows = {}
+        self.Size = 0
+
+    def append(self, name, features, action, reward):
+        row = self.Size
+        if row == self.S.shape[0]:
+            # grow by doubling, the rows written are kept
+            self.S = np.concatenate((self.S, np.empty_like(self.S)))
+            self.A = np.concatenate((self.A, np.empty_like(self.A)))
+            self.R = np.concatenate((self.R, np.empty_like(self.R)))
+        self.S[row] = features
+        self.A[row] = action
+        self.R[row] = reward
+        self.Rows.setdefault(name, []).append(row)
+        self.Size = row + 1
+
+    def view(self):
+        """
+        return the states and actions written since the last clear() as 2-D np.arrays.
+        The returned arrays are views which stay valid until the next append().
+        """
+        return self.S[:self.Size], self.A[:self.Size]
+
+    def clear(self):
+        self.Rows = {}
+        self.Size = 0
+
 def LoadJsonConfig(path):
     with open(path, 'r') as f:
         data = json.load(f)
@@ -77,6 +144,11 @@ def ColorPrint(color, msg):
 
 def gen_plot(GraphTitle, InputList):
     """Create a pyplot plot and save to buffer."""
+    # importing pyplot is slow, only do it when plotting
+    import matplotlib
+    # do not use x-server
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
     plt.figure()
     plt.plot(InputList)
     plt.title(GraphTitle)
@@ -85,6 +157,15 @@ def gen_plot(GraphTitle, InputList):
     buf.seek(0)
     return buf
 
+def SearchCandidates(TargetName, Candidates):
+    """
+    return the first name in Candidates containing TargetName, or None.
+    """
+    for candidate in Candidates:
+        if TargetName in candidate:
+            return candidate
+    return None
+
 class EnvCalculator(object):
     def getMostInfluentialState(states, ResetInfo):
         """
@@ -110,30 +191,21 @@ class EnvCalculator(object):
             '''
             select the function with probilities which from profiled usage
             '''
-            FunctionList = list(states.keys())
-            done = False
-            # build list of [key, usage]
-            UsageList = []
-            for name, usage in Stats.items():
-                UsageList.append([name, usage])
-            # based on the usage, sort it
-            sorted(UsageList, key=operator.itemgetter(1), reverse=True)
-            NameList = []
-            UsageTmpList = []
-            for item in UsageList:
-                NameList.append(item[0])
-                UsageTmpList.append(item[1])
+            FunctionList = tuple(states.keys())
+            # function names in descending order of usage
+            NameList = sorted(Stats, key=Stats.get, reverse=True)
             # 90% based on the usage
             prob = random.uniform(0, 1)
             if prob < 0.9:
                 # for python 3.6
-                #key = random.choice(NameList, weights=UsageTmpList)[0]
+                #key = random.choices(NameList, weights=[Stats[name] for name in NameList])[0]
                 # for python 3.5
                 choiceList = []
-                UsageSum = sum(UsageTmpList)
-                for index, elem in enumerate(UsageTmpList):
-                    choiceList += NameList[index] * int((UsageTmpList[index]/UsageSum)*100)
-                key = random.choice(choiceList)
+                UsageSum = sum(Stats.values())
+                for name in NameList:
+                    choiceList += [name] * int((Stats[name]/UsageSum)*100)
+                # every function may take less than 1%, use the most used one
+                key = random.choice(choiceList) if choiceList else NameList[0]
             else:
                 key = random.choice(FunctionList)
         try:
@@ -143,50 +215,35 @@ class EnvCalculator(object):
             Random selection will never come to here.
             This is caused by perf profiled information which does not contain the function arguments.
             '''
+            realKey = None
             try:
                 # use RegExp to search C++ style name or ambiguity of arguments.
-                done = False
                 for cand in NameList:
                     # searching based on the usage order in descending.
                     realKey = EnvCalculator.RegExpSearch(cand, FunctionList)
                     if realKey is not None:
-                        done = True
                         break
-                if not done:
+                else:
                     # if we cannot find the key, use the random one.
                     realKey = random.choice(FunctionList)
                 retVec = states[realKey]
             except Exception as e:
-                print("Unexpected exception\nkey={}\nrealKey={}\ndict.keys()={}\nreason={}\n".format(key, realKey ,states.keys()), e)
-        return np.asarray(retVec)
+                print("Unexpected exception\nkey={}\nrealKey={}\ndict.keys()={}\nreason={}\n".format(key, realKey, states.keys(), e))
+        return np.asarray(retVec, dtype=np.float32)
 
     def RegExpSearch(TargetName, List):
         """
-        Use regular exp. to search whether the List contains the TargetName.
+        Search whether any name in the List contains the TargetName.
         Inputs:
             TargetName: the name you would like to find.
             List: list of candidates for searching.
         Return:
             The matched name in List or None
         """
-        retName = None
-        done = False
-        for candidate in List:
-            matched = re.search(re.escape(TargetName), candidate)
-            if matched is not None:
-                retName = candidate
-                done = True
-                break
-        if not done:
-            ReEscapedInput = re.escape(TargetName)
-            SearchTarget = ".*{name}.*".format(name=ReEscapedInput)
-            r = re.compile(SearchTarget)
-            reRetList = list(filter(r.search, List))
-            if reRetList:
-                retName = reRetList[0]
-        return retName
+        # re.search() with the escaped name was a plain substring search
+        return SearchCandidates(TargetName, List)
 
-    def calcEachReward(newInfo, MeanSigmaDict, Features, oldInfo, oldCycles, FirstEpi=False):
+    def calcEachReward(newInfo, MeanSigmaDict, Features, oldInfo, oldCycles, FirstEpi=False, NameMapDict=None):
         """
         return dict={"function-name": reward(float)}
 
@@ -194,6 +251,8 @@ class EnvCalculator(object):
             oldInfo will be the ResetInfo
         if FirstEpi == False:
             oldInfo will be the usage dict from last epi.
+        NameMapDict: the function name mapping of this episode, updated inplace.
+            Pass the same dict for all steps of an episode, the names are searched only once.
         """
         Stats = newInfo["FunctionUsageDict"]
         TotalCycles = newInfo["TotalCyclesStat"]
@@ -203,35 +262,32 @@ class EnvCalculator(object):
         (Info["FunctionUsageDict"] <--> Features)
         {"perf_style_name": "clang_style_name"}
         '''
-        NameMapDict = {}
-        AllFunctions = list(Features.keys())
-        for perfName in list(Stats.keys()):
-            NameMapDict[perfName] = EnvCalculator.RegExpSearch(perfName, AllFunctions)
+        if NameMapDict is None:
+            NameMapDict = {}
+        AllFunctions = tuple(Features.keys())
+        resetStats = oldInfo["FunctionUsageDict"] if FirstEpi == True else {}
+        # only the names not seen in this episode are searched
+        for perfName in set(Stats).union(resetStats).difference(NameMapDict):
+            NameMapDict[perfName] = SearchCandidates(perfName, AllFunctions)
         '''
         Create usage dict with clang_style_name as key.
         if not profiled, the value will be None
         '''
         newAllUsageDict = {k : None for k in AllFunctions}
-        for perf_name, clang_name in NameMapDict.items():
-            newAllUsageDict[clang_name] = Stats[perf_name]
+        for perf_name, usage in Stats.items():
+            newAllUsageDict[NameMapDict[perf_name]] = usage
         '''
         Prepare the old usage dict
         '''
         if FirstEpi == True:
-            resetStats = oldInfo["FunctionUsageDict"]
-            resetNameMapDict = {}
-            resetAllFunctions = list(Features.keys())
-            for perfName in list(resetStats.keys()):
-                resetNameMapDict[perfName] = EnvCalculator.RegExpSearch(perfName, resetAllFunctions)
-            oldAllUsageDict = {k : None for k in resetAllFunctions}
-            for perf_name, clang_name in resetNameMapDict.items():
-                oldAllUsageDict[clang_name] = resetStats[perf_name]
+            oldAllUsageDict = {k : None for k in AllFunctions}
+            for perf_name, usage in resetStats.items():
+                oldAllUsageDict[NameMapDict[perf_name]] = usage
         else:
             oldAllUsageDict = oldInfo
         '''
         Calculate real reward based on the (new/old)AllUsageDict and MeanSigmaDict for all functions
         '''
-        rewards = {f : None for f in AllFunctions}
         target = newInfo['Target']
         old_total_cycles = oldCycles
         new_total_cycles = TotalCycles
@@ -258,130 +314,88 @@ class EnvCalculator(object):
         elif SigmaRatio < 1.0:
             SigmaRatio *= 0.5 # 95%-68% data is not that convincing.
 
-        UsageNumOverAll = 0
-        for name, usage in newAllUsageDict.items():
-            if usage is not None:
-                UsageNumOverAll += 1
-        UsageProfiledRatio = UsageNumOverAll/len(newAllUsageDict)
-        for FunctionName in AllFunctions:
-            old_usage = oldAllUsageDict[FunctionName]
-            new_usage = newAllUsageDict[FunctionName]
-            UseOverallPerf = False
-            '''
-            The Alpha and Beta need to be tuned.
-            '''
-            Alpha = 20
-            Beta = 2
-            isSpeedup = False
-            isSlowDown = False
-            if old_usage is None and new_usage is None:
-                '''
-                This function does not matters
-                '''
-                UseOverallPerf = True
-            # treat the function that miss either old or new usage as the both not profiled function.
-            elif old_usage is None or new_usage is None:
-                UseOverallPerf = True
-                """
-            elif old_usage is None:
-                '''
-                may be slow down
-                '''
-                UseOverallPerf = True
-                Alpha *= Beta
-                isSlowDown = True
-            elif new_usage is None:
-                '''
-                may be speedup
-                '''
-                UseOverallPerf = True
-                Alpha *= Beta
-                isSpeedup = True
-                """
-            else:
-                '''
-                This may be more accurate
-                How important: based on how many functions are profiled.
-                '''
-                UseOverallPerf = False
-                #Alpha = Alpha*(Beta*(1 / UsageProfiledRatio)) * 2 # more important
-                Alpha = Alpha*Beta*5 # more important
-                #print("UsageProfiledRatio={}".format(UsageProfiledRatio))
-            if UseOverallPerf:
-                '''
-                if isSlowDown == True and delta_total_cycles > 0:
-                    Alpha /= Beta
-                    #delta_total_cycles *= -1
-                elif isSpeedup == True and delta_total_cycles < 0:
-                    Alpha /= Beta
-                    #delta_total_cycles *= -1
-                '''
-                reward = Alpha*SigmaRatio*(delta_total_cycles/old_total_cycles)
-            else:
-                old_function_cycles = old_total_cycles * old_usage
-                new_function_cycles = new_total_cycles * new_usage
-                delta_function_cycles = old_function_cycles - new_function_cycles
-                reward = Alpha*SigmaRatio*(delta_function_cycles/old_function_cycles)
-            rewards[FunctionName] = reward
+        '''
+        The Alpha and Beta need to be tuned.
+        '''
+        Alpha = 20
+        Beta = 2
+        # usage of each function, NaN if it is not profiled
+        old_usage = np.array([np.nan if oldAllUsageDict[f] is None else oldAllUsageDict[f]
+            for f in AllFunctions], dtype=np.float64)
+        new_usage = np.array([np.nan if newAllUsageDict[f] is None else newAllUsageDict[f]
+            for f in AllFunctions], dtype=np.float64)
+        # treat the function that miss either old or new usage as the both not profiled function.
+        profiled = ~(np.isnan(old_usage) | np.isnan(new_usage))
+        '''
+        Not profiled: this function does not matters, use the overall performance.
+        '''
+        reward = np.full(len(AllFunctions), Alpha*SigmaRatio*(delta_total_cycles/old_total_cycles))
+        '''
+        Profiled: this may be more accurate
+        '''
+        old_function_cycles = old_total_cycles * old_usage[profiled]
+        new_function_cycles = new_total_cycles * new_usage[profiled]
+        delta_function_cycles = old_function_cycles - new_function_cycles
+        # zero usage raises like the ZeroDivisionError of python floats
+        with np.errstate(divide='raise', invalid='raise'):
+            # more important
+            reward[profiled] = Alpha*Beta*5*SigmaRatio*(delta_function_cycles/old_function_cycles)
+        rewards = dict(zip(AllFunctions, reward.tolist()))
         # return newAllUsageDict to be the "old" for next episode
         return rewards, newAllUsageDict
 
-    def appendStateRewards(buffer_s, buffer_a, buffer_r, states, rewards, action):
+    def appendStateRewards(buffer, states, rewards, action):
         """
-        Buffers are append inplace in buffer_x
-        buffer_s : dict of np.array as features
-        buffer_a : dict of list of actions(int)
-        buffer_r : dict of rewards(float)
+        Transitions are appended inplace in buffer(TransitionBuffer),
+        one row for each function which has both features and reward.
         Return value: the number of valid data
         """
-        tmpStates = states.copy()
-        for name, featureList in tmpStates.items():
-            # For some reason, the name may be '' (remove it!)
-            if not name:
-                target = ''
-                states.pop(target, None)
-                if rewards.get(target) is not None:
-                    rewards.pop(target, None)
+        # For some reason, the name may be '' (remove it!)
+        if '' in states:
+            states.pop('')
+            rewards.pop('', None)
+        append = buffer.append
         Count = 0
         for name, featureList in states.items():
-            if buffer_s.get(name) is None:
-                buffer_s[name] = []
-                buffer_a[name] = []
-                buffer_r[name] = []
             '''
             Our function-name matching mechanism may fail sometimes.
             ex. key='btEmptyAlgorithm::~btEmptyAlgorithm()' will fail
             This does not matter a lot, so we skip it now by checking the key existence.
             '''
             if name in rewards:
-                buffer_s[name].append(np.asarray(featureList, dtype=np.float32))
-                buffer_a[name].append(action)
-                buffer_r[name].append(rewards[name])
+                append(name, featureList, action, rewards[name])
                 Count += 1
         return Count
 
-    def calcDiscountedRewards(buffer_r, nextObs, ppo):
+    def discount(rewards, bootstrap, gamma):
         """
-        return a dict of list of discounted rewards
-        {"function-name":[discounted rewards]}
+        return the discounted rewards of a 1-D np.array of rewards followed by bootstrap:
+        ret[i] = rewards[i] + gamma*rewards[i+1] + ... + gamma**(n-i)*bootstrap
         """
-        retDict = {}
-        for name, FeatureList in nextObs.items():
+        n = rewards.shape[0]
+        # exponent[i, j] = j - i, the rewards before i are masked out by triu
+        exponent = np.arange(n + 1) - np.arange(n)[:, np.newaxis]
+        weights = np.triu(gamma ** np.maximum(exponent, 0))
+        return weights.dot(np.append(rewards, bootstrap))
+
+    def calcDiscountedRewards(buffer, nextObs, ppo):
+        """
+        return a 2-D np.array of discounted rewards, one row for each row in buffer.
+        The rewards are discounted along the rows of the same function.
+        """
+        discounted_r = np.empty((buffer.Size, 1), dtype=np.float32)
+        '''
+        Get estimated rewards of all functions from critic at once,
+        get_v() evaluates them in inference mode, they do not affect each other
+        '''
+        nextOb = np.asarray([nextObs[name] for name in buffer.Rows], dtype=np.float32)
+        StateValues = ppo.get_v(nextOb)
+        for rows, StateValue in zip(buffer.Rows.values(), StateValues):
             '''
-            Get estimated rewards from critic
+            Calculate discounted rewards
             '''
-            nextOb = np.asarray(FeatureList, dtype=np.float32)
-            StateValue = ppo.get_v(nextOb)
-            discounted_r = []
-            for r in buffer_r[name][::-1]:
-                '''
-                Calculate discounted rewards
-                '''
-                StateValue = r + ppo.GAMMA * StateValue
-                discounted_r.append(StateValue)
-            discounted_r.reverse()
-            retDict[name] = discounted_r
-        return retDict
+            discounted_r[rows, 0] = EnvCalculator.discount(buffer.R[rows, 0], StateValue, ppo.GAMMA)
+        return discounted_r
 
 
     def calcEpisodeReward(rewards):
@@ -396,9 +410,12 @@ class EnvCalculator(object):
         return total
 
 
+    @functools.lru_cache(maxsize=1)
     def getCpuMeanSigmaInfo():
         """
         return a dict{"target name": {"mean": int, "sigma": int}}
+        The file does not change during training, so it is parsed once and shared by all workers.
+        Do not modify the returned dict.
         """
         path = os.getenv('LLVM_THESIS_RandomHome', 'Error')
         if path == 'Error':
@@ -407,7 +424,7 @@ class EnvCalculator(object):
         path = path + '/LLVMTestSuiteScript/GraphGen/output/newMeasurableStdBenchmarkMeanAndSigma'
         if not os.path.exists(path):
             print("{} does not exist.".format(path), file=sys.stderr)
-            sus.exit(1)
+            sys.exit(1)
         retDict = {}
         with open(path, 'r') as file:
             for line in file:
@@ -423,19 +440,6 @@ class EnvCalculator(object):
             file.close()
         return retDict
 
-    def DictToVstack(buffer_s, buffer_a, buffer_r):
-        """
-        return vstack of state(normalized), action and rewards.
-        """
-        list_s = []
-        list_a = []
-        list_r = []
-        for name, values in buffer_s.items():
-            list_s.extend(buffer_s[name])
-            list_a.extend(buffer_a[name])
-            list_r.extend(buffer_r[name])
-        return np.vstack(list_s), np.vstack(list_a), np.vstack(list_r)
-
     def RemoveTrivialData(vstack_s, vstack_a, vstack_r, AbandonRatio=0):
         """
         Too many not important data, we need to remove some.
@@ -17,30 +17,18 @@ However, the internal structure is tuned for gym_OptClang.
 """
 import tensorflow as tf
 import numpy as np
-import matplotlib
-# do not use x-server
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import gym, gym_OptClang
-import random, threading, queue, operator, os, sys, re
-from operator import itemgetter
-from random import shuffle
-import random
-from colorama import Fore, Style
-from datetime import datetime
-from sklearn.preprocessing import StandardScaler
+import threading, queue, os, sys
+from colorama import Fore
 import time
-import io
-from time import gmtime, strftime
-import argparse
-import pytz
 import Helpers as hp
 
 class PPO(object):
-    def __init__(self, env, ckptLocBase, ckptName, isTraining, EP_MAX, GAMMA, A_LR, C_LR, ClippingEpsilon, UpdateDepth, L1Neurons, L2Neurons, LR_DECAY=1, LR_DECAY_FREQ=1000,SharedStorage=None):
+    def __init__(self, env, ckptLocBase, ckptName, isTraining, EP_MAX, GAMMA, A_LR, C_LR, ClippingEpsilon, UpdateDepth, L1Neurons, L2Neurons, LR_DECAY=1, LR_DECAY_FREQ=1000,SharedStorage=None, MixedPrecision=False, SharedTrunk=False, Normalization='batch', SaveFreq=50, UseXLA=False):
         tf.reset_default_graph()
         # if SharedStorage is None, it must be in inference mode without "update()"
         self.SharedStorage = SharedStorage
+        # if InferenceServer is set, choose_action() batches the states across workers
+        self.InferenceServer = None
         self.EP_MAX = EP_MAX
         self.GAMMA = GAMMA
         self.A_LR = A_LR
@@ -49,13 +37,49 @@ class PPO(object):
         self.LR_DECAY_FREQ = LR_DECAY_FREQ
         self.ClippingEpsilon = ClippingEpsilon
         self.UpdateDepth = UpdateDepth
+        # save the model for every SaveFreq updates
+        self.SaveFreq = SaveFreq
+        self.SaveThread = None
         self.L1Neurons = L1Neurons
         self.L2Neurons = L2Neurons
+        if Normalization not in ('batch', 'layer', 'none'):
+            raise ValueError("Normalization must be 'batch', 'layer' or 'none', got {}".format(Normalization))
+        # run the matmuls after the first layer in float16.
+        # The features are raw counts which overflow float16, so the first layer stays in float32,
+        # and the later layers need normalized inputs.
+        self.MixedPrecision = MixedPrecision and Normalization != 'none'
+        if MixedPrecision and not self.MixedPrecision:
+            hp.ColorPrint(Fore.LIGHTRED_EX, "MixedPrecision needs Normalization, use float32 only.")
+        # critic uses the hidden layers of actor instead of its own
+        self.SharedTrunk = SharedTrunk
+        # normalization of hidden layers: 'batch', 'layer' or 'none'
+        self.Normalization = Normalization
         self.S_DIM = len(env.observation_space.low)
         self.A_DIM = env.action_space.n
         self.A_SPACE = 1
-        self.sess = tf.Session(graph=tf.get_default_graph())
-        self.tfs = tf.placeholder(tf.float32, [None, self.S_DIM], 'state')
+        SessConfig = tf.ConfigProto()
+        if UseXLA:
+            # let XLA fuse the small ops of the fully connected layers into fewer kernels
+            SessConfig.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        self.sess = tf.Session(graph=tf.get_default_graph(), config=SessConfig)
+        # the batch of an update is copied into these once, see update()
+        with tf.variable_scope('Staging'):
+            self.StagedS = self._staged_variable(tf.float32, self.S_DIM, 'state')
+            self.StagedA = self._staged_variable(tf.int32, 1, 'action')
+            self.StagedR = self._staged_variable(tf.float32, 1, 'discounted_r')
+            self.StagedAdv = self._staged_variable(tf.float32, 1, 'advantage')
+            # feed True to train on the staged batch
+            self.UseStaged = tf.placeholder_with_default(False, [], 'use_staged')
+        '''
+        Batch norm uses the statistics of the batch only when update() feeds True.
+        The other forward passes use the moving averages, so the states batched by InferenceServer
+        do not affect each other, and the moving averages are not updated by them.
+        '''
+        self.BNTraining = tf.placeholder_with_default(False, [], 'bn_training')
+        # feed a single state to tfs_single, or a batch of states to tfs
+        self.tfs = tf.placeholder_with_default(
+                tf.cond(self.UseStaged, lambda: tf.identity(self.StagedS), self._single_state),
+                [None, self.S_DIM], 'state')
         self.ckptLocBase = ckptLocBase
         self.UpdateStepFile = self.ckptLocBase + '/UpdateStep'
         self.ActorLrFile = self.ckptLocBase + '/ActorLrFile'
@@ -91,48 +115,68 @@ class PPO(object):
             self.isTraining = True
             hp.ColorPrint(Fore.LIGHTCYAN_EX, "This is training procedure with UpdateStep={}".format(self.UpdateStep))
 
+        # pi: logits of actions
+        pi_logits, pi_params, pi_hidden = self._build_anet('Actor', trainable=True)
+        oldpi_logits, oldpi_params, _ = self._build_anet('oldActor', trainable=False)
+
         # critic
         with tf.variable_scope('Critic'):
-            with tf.variable_scope('Fully_Connected'):
-                l1 = self.add_layer(self.tfs, self.L1Neurons, activation_function=tf.nn.relu, norm=True)
-                if self.L2Neurons != 0:
-                    l2 = self.add_layer(l1, self.L2Neurons, activation_function=tf.nn.relu, norm=True)
+            if self.SharedTrunk:
+                hidden = pi_hidden
+            else:
+                with tf.variable_scope('Fully_Connected'):
+                    hidden = self._build_hidden(trainable=True)
             with tf.variable_scope('Value'):
-                if self.L2Neurons != 0:
-                    self.v = tf.layers.dense(l2, 1)
-                else:
-                    self.v = tf.layers.dense(l1, 1)
+                self.v = tf.layers.dense(hidden, 1)
             with tf.variable_scope('Loss'):
-                self.tfdc_r = tf.placeholder(tf.float32, [None, 1], 'discounted_r')
+                self.tfdc_r = tf.placeholder_with_default(self.StagedR, [None, 1], 'discounted_r')
                 self.advantage = self.tfdc_r - self.v
                 self.closs = tf.reduce_mean(tf.square(self.advantage))
                 self.CriticLossSummary = tf.summary.scalar('CriticLoss', self.closs)
-            with tf.variable_scope('CriticTrain'):
-                self.ctrain_op = tf.train.AdamOptimizer(self.C_LR).minimize(self.closs)
+            if not self.SharedTrunk:
+                with tf.variable_scope('CriticTrain'):
+                    self.ctrain_op = tf.train.AdamOptimizer(self.C_LR).minimize(self.closs)
 
-        # pi: act_probs
-        pi, pi_params = self._build_anet('Actor', trainable=True)
-        oldpi, oldpi_params = self._build_anet('oldActor', trainable=False)
         # operation of choosing action
         with tf.variable_scope('ActionsExp.'):
-            self.acts_expect = tf.squeeze(pi, axis=0)
+            self.acts_prob = tf.nn.softmax(pi_logits)
+            self.acts_expect = tf.squeeze(self.acts_prob, axis=0)
+            # True for the passes which were applied, they will not be chosen again
+            self.used_mask = tf.placeholder(tf.bool, [None, self.A_DIM], 'used_mask')
+            # log(0)=-inf for the used passes, log(1)=0 for the others
+            unused = tf.log(tf.to_float(tf.logical_not(self.used_mask)))
+            masked_logits = pi_logits + unused
+            if self.isTraining == True:
+                '''
+                During training, we need some chance to get unexpected action to let
+                the agent face different conditions as much as possible.
+                '''
+                # the most possible action
+                # some probs may be the same, choose one of them randomly
+                best = tf.equal(masked_logits, tf.reduce_max(masked_logits, axis=1, keep_dims=True))
+                greedy = tf.multinomial(tf.log(tf.to_float(best)), num_samples=1)[:, 0]
+                # random action
+                explore = tf.multinomial(unused, num_samples=1)[:, 0]
+                # 80% for the most possible action
+                self.sample_op = tf.where(
+                        tf.random_uniform(tf.shape(greedy)) < 0.8, greedy, explore)
+            else:
+                self.sample_op = tf.argmax(masked_logits, axis=1)
         with tf.variable_scope('Update'):
-            self.update_oldpi_op = [oldp.assign(p) for p, oldp in zip(pi_params, oldpi_params)]
+            self.update_oldpi_op = tf.group(*[oldp.assign(p) for p, oldp in zip(pi_params, oldpi_params)])
 
         with tf.variable_scope('Actor/PPO-Loss'):
-            self.tfa = tf.placeholder(tf.int32, [None, 1], 'action')
-            self.tfadv = tf.placeholder(tf.float32, [None, 1], 'advantage')
-            # probabilities of actions which agent took with policy
-            # depth=pi.shape[0] <-- each column is viewed as a vector
-            # depth=pi.shape[1] <-- each row is viewed as a vector <-- we use this
-            act_probs = pi * tf.one_hot(indices=self.tfa, depth=pi.shape[1])
-            act_probs = tf.reduce_sum(act_probs, axis=1)
-            # probabilities of actions which old agent took with policy
-            act_probs_old = oldpi * tf.one_hot(indices=self.tfa, depth=oldpi.shape[1])
-            act_probs_old = tf.reduce_sum(act_probs_old, axis=1)
-            # add a small number to avoid NaN
-            #ratio = tf.divide(act_probs + 1e-10, act_probs_old + 1e-10)
-            ratio = tf.exp(tf.log(act_probs + 1e-10) - tf.log(act_probs_old + 1e-10))
+            self.tfa = tf.placeholder_with_default(self.StagedA, [None, 1], 'action')
+            # the advantage is staged with the batch, from the critic before the update
+            self.tfadv = tf.placeholder_with_default(self.StagedAdv, [None, 1], 'advantage')
+            action = tf.squeeze(self.tfa, axis=1)
+            # log probabilities of actions which agent took with policy
+            logp = -tf.nn.sparse_softmax_cross_entropy_with_logits(labels=action, logits=pi_logits)
+            # log probabilities of actions which old agent took with policy
+            logp_old = -tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    labels=action, logits=tf.stop_gradient(oldpi_logits))
+            # pi/oldpi in log space, one column to match self.tfadv
+            ratio = tf.expand_dims(tf.exp(logp - logp_old), axis=1)
             surr = tf.multiply(ratio, self.tfadv)
             clip = tf.clip_by_value(ratio, 1.-self.ClippingEpsilon, 1.+self.ClippingEpsilon)*self.tfadv
             # clipped surrogate objective
@@ -142,7 +186,31 @@ class PPO(object):
             self.ActorLossSummary = tf.summary.scalar('ActorLoss', self.aloss)
 
         with tf.variable_scope('ActorTrain'):
-            self.atrain_op = tf.train.AdamOptimizer(self.A_LR).minimize(self.aloss)
+            if self.SharedTrunk:
+                '''
+                Two optimizers in one sess.run would read and write the shared layers in no order,
+                so one optimizer minimizes both losses, weighted by their learning rates.
+                '''
+                self.atrain_op = tf.train.AdamOptimizer(self.A_LR).minimize(
+                        self.aloss + (self.C_LR / self.A_LR) * self.closs)
+            else:
+                self.atrain_op = tf.train.AdamOptimizer(self.A_LR).minimize(self.aloss)
+
+        with tf.variable_scope('Train'):
+            # feed the batch to tfs, tfa and tfdc_r once, the advantage is computed on the way
+            self.stage_op = tf.group(
+                    tf.assign(self.StagedS, self.tfs, validate_shape=False),
+                    tf.assign(self.StagedA, self.tfa, validate_shape=False),
+                    tf.assign(self.StagedR, self.tfdc_r, validate_shape=False),
+                    tf.assign(self.StagedAdv, self.advantage, validate_shape=False))
+            # one sess.run steps both
+            if self.SharedTrunk:
+                self.train_op = self.atrain_op
+            else:
+                self.train_op = tf.group(self.atrain_op, self.ctrain_op)
+            # merge once, tf.summary.merge() adds new nodes to the graph on every call
+            self.UpdateSummary = tf.summary.merge(
+                    [self.ActorLossSummary, self.CriticLossSummary, self.ppoRatioSummary])
 
         with tf.variable_scope('Summary'):
             self.OverallSpeedup = tf.placeholder(tf.float32, name='OverallSpeedup')
@@ -152,16 +220,25 @@ class PPO(object):
             self.SpeedupSummary = tf.summary.scalar('OverallSpeedup', self.RecordSpeedup_op)
             self.RecordEpiReward_op = tf.multiply(self.EpisodeReward, self.one)
             self.EpiRewardSummary = tf.summary.scalar('EpisodeReward', self.RecordEpiReward_op)
+            self.EvalSummary = tf.summary.merge([self.SpeedupSummary, self.EpiRewardSummary])
 
         self.writer = tf.summary.FileWriter(self.ckptLocBase, self.sess.graph)
+        # (summary, step) to write, None to flush and stop
+        self.SummaryQueue = queue.Queue()
+        self.SummaryThread = threading.Thread(target=self.write_summaries, daemon=True)
+        self.SummaryThread.start()
         self.sess.run(tf.global_variables_initializer())
-        self.saver = tf.train.Saver()
+        # the staged variables are local, they are not saved in the checkpoint
+        self.sess.run(tf.local_variables_initializer())
+        self.saver = tf.train.Saver(max_to_keep=3, save_relative_paths=True)
         '''
         If the ckpt exist, restore it.
         '''
-        if tf.train.checkpoint_exists(self.ckptLoc):
+        # the checkpoints are numbered by UpdateStep, e.g. model.ckpt-50
+        LatestCkpt = tf.train.latest_checkpoint(self.ckptLocBase)
+        if LatestCkpt is not None:
             #self.saver.restore(self.sess, self.ckptLoc)
-            self.saver.restore(self.sess, tf.train.latest_checkpoint(self.ckptLocBase))
+            self.saver.restore(self.sess, LatestCkpt)
             hp.ColorPrint(Fore.LIGHTGREEN_EX, 'Restore the previous model.')
         elif self.isTraining == False:
             hp.ColorPrint(Fore.LIGHTRED_EX, "Missing trained model to inference, exit.")
@@ -169,82 +246,130 @@ class PPO(object):
 
     def save(self):
         """
-        Save model
+        Save model, the saver keeps the last 3 of them
+        """
+        self.saver.save(self.sess, self.ckptLoc, global_step=self.UpdateStep)
+
+    def save_async(self):
+        """
+        Save model in another thread.
+        The variables must not be changed before wait_save() returns.
+        Only update() changes them, and it calls wait_save() first:
+        the forward passes of the workers run batch norm with BNTraining=False,
+        which reads the moving averages without assigning them.
         """
-        self.saver.save(self.sess, self.ckptLoc)
+        self.wait_save()
+        self.SaveThread = threading.Thread(target=self.save)
+        self.SaveThread.start()
+
+    def wait_save(self):
+        """
+        Block until the saving from save_async() is done
+        """
+        if self.SaveThread is not None:
+            self.SaveThread.join()
+            self.SaveThread = None
 
     def update(self):
-        while not self.SharedStorage['Coordinator'].should_stop():
-            if self.SharedStorage['Counters']['ep'] < self.EP_MAX:
-                # blocking wait until get batch of data
-                self.SharedStorage['Events']['update'].wait()
-                # save the model
-                if self.UpdateStep % 50 == 0:
-                    self.save()
-                    hp.ColorPrint(Fore.LIGHTRED_EX, "Save for every 50 updates.")
-                else:
-                    hp.ColorPrint(Fore.LIGHTBLUE_EX,
-                            "This update does not need to be saved: {}".format(self.UpdateStep))
-                # learning rate decay
-                if self.UpdateStep % self.LR_DECAY_FREQ == (self.LR_DECAY_FREQ-1):
-                    # decay
-                    self.A_LR = self.A_LR * self.LR_DECAY
-                    self.C_LR = self.C_LR * self.LR_DECAY
-                    # save
-                    with open(self.ActorLrFile, 'w') as f:
-                        f.write(str(self.A_LR))
-                    with open(self.CriticLrFile, 'w') as f:
-                        f.write(str(self.C_LR))
-                    hp.ColorPrint(Fore.LIGHTRED_EX,
-                            "Decay LR: A_LR={}, C_LR={}".format(self.A_LR, self.C_LR))
-                # copy pi to old pi
-                self.sess.run(self.update_oldpi_op)
-                # collect data from all workers
-                data = [self.SharedStorage['DataQueue'].get() for _ in range(self.SharedStorage['DataQueue'].qsize())]
-                data = np.vstack(data)
-                s, a, r = data[:, :self.S_DIM], data[:, self.S_DIM: self.S_DIM + self.A_SPACE], data[:, -1:]
-                adv = self.sess.run(self.advantage, {self.tfs: s, self.tfdc_r: r})
-                # update actor and critic in a update loop
-                for _ in range(self.UpdateDepth):
-                    self.sess.run(self.atrain_op, {self.tfs: s, self.tfa: a, self.tfadv: adv})
-                    self.sess.run(self.ctrain_op, {self.tfs: s, self.tfdc_r: r})
-                '''
-                write summary
-                '''
-                # actor and critic loss
-                result = self.sess.run(
-                            tf.summary.merge([self.ActorLossSummary, self.CriticLossSummary, 
-                                self.ppoRatioSummary]),
-                            feed_dict={self.tfs: s, self.tfa: a, self.tfadv: adv, self.tfdc_r: r})
-                self.writer.add_summary(result, self.UpdateStep)
-                self.UpdateStep += 1
-                # re-train will not overlap the summaries
-                with open(self.UpdateStepFile, 'w') as f:
-                    f.write(str(self.UpdateStep))
-
-                # updating finished
-                self.SharedStorage['Events']['update'].clear()
-                self.SharedStorage['Locks']['counter'].acquire()
-                # reset counter
-                self.SharedStorage['Counters']['update_counter'] = 0
-                self.SharedStorage['Locks']['counter'].release()
-                # set collecting available
-                self.SharedStorage['Events']['collect'].set()
+        """
+        Update PPO whenever all workers put their batch of data, until the coordinator stops.
+        If the updater fails, stop the training instead of leaving the workers at the barrier.
+        """
+        try:
+            with self.SharedStorage['Coordinator'].stop_on_exception():
+                self.update_loop()
+        finally:
+            # wake up the threads waiting at the barrier
+            self.SharedStorage['Barrier'].abort()
+            self.wait_save()
+            # write the queued summaries before the process exits
+            self.SummaryQueue.put(None)
+            self.SummaryThread.join()
         hp.ColorPrint(Fore.YELLOW, 'Updator stopped')
 
-    def add_layer(self, inputs, out_size, trainable=True,activation_function=None, norm=False):
+    def update_loop(self):
+        while not self.SharedStorage['Coordinator'].should_stop():
+            if self.SharedStorage['Counters']['ep'] >= self.EP_MAX:
+                # e.g. restored from a finished log dir, or the last episode was just counted
+                self.SharedStorage['Coordinator'].request_stop()
+                break
+            try:
+                # blocking wait until all workers put their batch of data
+                self.SharedStorage['Barrier'].wait()
+            except threading.BrokenBarrierError:
+                # training is stopped
+                break
+            # the model from the last update may be still saving
+            self.wait_save()
+            # learning rate decay
+            if self.UpdateStep % self.LR_DECAY_FREQ == (self.LR_DECAY_FREQ-1):
+                # decay
+                self.A_LR = self.A_LR * self.LR_DECAY
+                self.C_LR = self.C_LR * self.LR_DECAY
+                # save
+                with open(self.ActorLrFile, 'w') as f:
+                    f.write(str(self.A_LR))
+                with open(self.CriticLrFile, 'w') as f:
+                    f.write(str(self.C_LR))
+                hp.ColorPrint(Fore.LIGHTRED_EX,
+                        "Decay LR: A_LR={}, C_LR={}".format(self.A_LR, self.C_LR))
+            # copy pi to old pi
+            self.sess.run(self.update_oldpi_op)
+            # collect data from all workers
+            data = [buf.drain() for buf in self.SharedStorage['DataBuffers']]
+            s, a, r = [np.concatenate(column) for column in zip(*data)]
+            # copy the batch into the graph once, the update loop reads the staged batch with UseStaged
+            self.sess.run(self.stage_op, {self.tfs: s, self.tfa: a.astype(np.int32), self.tfdc_r: r,
+                    self.BNTraining: True})
+            UpdateFeed = {self.UseStaged: True, self.BNTraining: True}
+            for _ in range(self.UpdateDepth - 1):
+                self.sess.run(self.train_op, UpdateFeed)
+            '''
+            write summary
+            '''
+            # actor and critic loss, fetched with the last train step
+            _, result = self.sess.run([self.train_op, self.UpdateSummary], UpdateFeed)
+            self.SummaryQueue.put((result, self.UpdateStep))
+            self.UpdateStep += 1
+            # re-train will not overlap the summaries
+            with open(self.UpdateStepFile, 'w') as f:
+                f.write(str(self.UpdateStep))
+
+            try:
+                # updating finished, set collecting available
+                self.SharedStorage['Barrier'].wait()
+            except threading.BrokenBarrierError:
+                break
+            # save the model while workers are collecting
+            if self.UpdateStep % self.SaveFreq == 0:
+                self.save_async()
+                hp.ColorPrint(Fore.LIGHTRED_EX, "Save for every {} updates.".format(self.SaveFreq))
+            else:
+                hp.ColorPrint(Fore.LIGHTBLUE_EX,
+                        "This update does not need to be saved: {}".format(self.UpdateStep))
+
+    def add_layer(self, inputs, out_size, trainable=True,activation_function=None, norm=False, half=False):
         in_size = inputs.get_shape().as_list()[1]
         Weights = tf.Variable(tf.random_normal([in_size, out_size], mean=1.0, stddev=1.0), trainable=trainable)
         biases = tf.Variable(tf.zeros([1, out_size]) + 0.1, trainable=trainable)
 
         # fully connected product
-        Wx_plus_b = tf.matmul(inputs, Weights) + biases
+        if half:
+            # only the matmul is in float16, weights, normalization and softmax stay in float32
+            Wx = tf.matmul(tf.cast(inputs, tf.float16), tf.cast(Weights, tf.float16))
+            Wx_plus_b = tf.cast(Wx, tf.float32) + biases
+        else:
+            Wx_plus_b = tf.matmul(inputs, Weights) + biases
 
         # normalize fully connected product
-        if norm:
+        if norm and self.Normalization == 'layer':
+            # per-sample statistics, no moving averages to update in every forward pass
+            Wx_plus_b = tf.contrib.layers.layer_norm(Wx_plus_b, trainable=trainable)
+        elif norm and self.Normalization == 'batch':
             # Batch Normalize
             Wx_plus_b = tf.contrib.layers.batch_norm(
-                    Wx_plus_b, updates_collections=None, is_training=self.isTraining)
+                    Wx_plus_b, updates_collections=None,
+                    is_training=self.BNTraining if self.isTraining else False)
 
         # activation
         if activation_function is None:
@@ -255,27 +380,47 @@ class PPO(object):
 
         return outputs
 
+    def _single_state(self):
+        """
+        return tfs_single as a batch of one state.
+        It is created in the branch of tf.cond, so it only has to be fed when UseStaged is False.
+        """
+        self.tfs_single = tf.placeholder(tf.float32, [self.S_DIM], 'state_single')
+        return tf.expand_dims(self.tfs_single, axis=0)
+
+    def _staged_variable(self, dtype, width, name):
+        """
+        return a local variable of [rows, width] which can be assigned with any number of rows
+        """
+        return tf.Variable(tf.zeros([0, width], dtype=dtype), trainable=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES], validate_shape=False, name=name)
+
+    def _build_hidden(self, trainable):
+        """
+        return the last hidden layer of the fully connected layers on self.tfs
+        """
+        l1 = self.add_layer(self.tfs, self.L1Neurons, trainable,activation_function=tf.nn.relu, norm=True)
+        if self.L2Neurons != 0:
+            return self.add_layer(l1, self.L2Neurons, trainable,activation_function=tf.nn.relu, norm=True,
+                    half=self.MixedPrecision)
+        return l1
+
     def _build_anet(self, name, trainable):
         with tf.variable_scope(name):
             with tf.variable_scope('Fully_Connected'):
-                l1 = self.add_layer(self.tfs, self.L1Neurons, trainable,activation_function=tf.nn.relu, norm=True)
-                if self.L2Neurons != 0:
-                    l2 = self.add_layer(l1, self.L2Neurons, trainable,activation_function=tf.nn.relu, norm=True)
+                hidden = self._build_hidden(trainable)
             with tf.variable_scope('Action_Expectation'):
-                # softmax may lead to NaN
-                if self.L2Neurons != 0:
-                    expectation = \
-                            self.add_layer(l2, self.A_DIM, activation_function=tf.nn.softmax, norm=True)
-                else:
-                    expectation = \
-                            self.add_layer(l1, self.A_DIM, activation_function=tf.nn.softmax, norm=True)
+                # return the logits, softmax is applied by the callers
+                logits = self.add_layer(hidden, self.A_DIM, norm=True, half=self.MixedPrecision)
         params = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=name)
-        return expectation, params
+        return logits, params, hidden
 
     def choose_action(self, s, PassHistory):
         """
         return a int from 0 to 33
         Input "s" must be numpy array.
+        Input "PassHistory" is a np.bool_ array of length A_DIM, True for the applied passes.
+        It is updated inplace with the chosen pass.
         In the world of reinforcement learning, the action space is from 0 to 33.
         However, in the world of modified-clang, the accepted passes are from 1 to 34.
         Therefore, "gym-OptClang" already done this effort for us.
@@ -283,55 +428,42 @@ class PPO(object):
         However, if you use the model withou gym-OptClang, you have to convert by yourself.
         e.g. Inference example in our examples.
         """
-        s = s[np.newaxis, :]
-        a_expect = self.sess.run(self.acts_expect, {self.tfs: s})
-        print(a_expect)
-        '''
-        choose the one that was not applied yet
-        '''
-        # split the probabilities into list of [index ,probablities]
-        aList = a_expect.tolist()
-        probList = []
-        idx = 0
-        for prob in aList:
-            probList.append([idx, prob])
-            idx += 1
-        # some probs may be the same.
-        # Try to avoid that every time choose the same action
-        if self.isTraining == True:
-            shuffle(probList)
-        # sort with probs in descending order
-        probList.sort(key=itemgetter(1), reverse=True)
-        # find the one that is not applied yet
-        idx = 0
-        while True:
-            '''
-            During training, we need some chance to get unexpected action to let
-            the agent face different conditions as much as possible.
-            '''
-            # Use different strategies for different situations
-            if self.isTraining == True:
-                prob = random.uniform(0, 1)
-                if prob < 0.8:
-                    # the most possible action
-                    PassIdx = probList[idx][0]
-                    idx += 1
-                else:
-                    # random action
-                    PassIdx = np.random.choice(np.arange(self.A_DIM))
-            else:
-                PassIdx = probList[idx][0]
-                idx += 1
-            #print('PassIdx={} with {} prob'.format(PassIdx, actionProb[1]))
-            if PassIdx not in PassHistory:
-                PassHistory[PassIdx] = 'Used'
-                return PassIdx
-        # the code should never come to here
-        return 'Error'
+        if self.InferenceServer is not None:
+            PassIdx = self.InferenceServer.infer(s, PassHistory)
+        else:
+            # choose the one that was not applied yet
+            PassIdx = self.sess.run(self.sample_op,
+                    {self.tfs_single: s, self.used_mask: PassHistory[np.newaxis, :]})[0]
+        PassIdx = int(PassIdx)
+        PassHistory[PassIdx] = True
+        return PassIdx
 
     def get_v(self, s):
-        if s.ndim < 2: s = s[np.newaxis, :]
-        return self.sess.run(self.v, {self.tfs: s})[0, 0]
+        """
+        return the state value of a state,
+        or a 1-D np.array of the values of a batch of states(one state per row).
+        Batch norm uses the moving averages here, so each value is the same as evaluating its state alone.
+        """
+        if s.ndim < 2:
+            return self.sess.run(self.v, {self.tfs_single: s, self.BNTraining: False})[0, 0]
+        return self.sess.run(self.v, {self.tfs: s, self.BNTraining: False})[:, 0]
+
+    def write_summaries(self):
+        """
+        Write the summaries in SummaryQueue to the event file.
+        Running in its own thread, update() and DrawToTf() never wait for the file I/O.
+        Return after flushing when None is got.
+        """
+        count = 0
+        while True:
+            item = self.SummaryQueue.get()
+            if item is None:
+                self.writer.flush()
+                break
+            self.writer.add_summary(item[0], item[1])
+            count += 1
+            if count % 100 == 0:
+                self.writer.flush()
 
     def DrawToTf(self, speedup, overall_reward, step):
         """
@@ -339,12 +471,88 @@ class PPO(object):
         """
         try:
             result = self.sess.run(
-                        tf.summary.merge([self.SpeedupSummary, self.EpiRewardSummary]),
+                        self.EvalSummary,
                         feed_dict={self.OverallSpeedup: speedup,
                                    self.EpisodeReward: overall_reward})
-            self.writer.add_summary(result, step)
+            self.SummaryQueue.put((result, step))
             with open(self.ckptLocBase + '/EpiStepFile', 'w') as f:
                 f.write(str(step))
-            self.writer.flush()
         except Exception as e:
-            ColorPrint(Fore.LIGHTRED_EX, "SpeedupSummary or EpiRewardSummary failed: {}".fomat(e))
+            hp.ColorPrint(Fore.LIGHTRED_EX, "SpeedupSummary or EpiRewardSummary failed: {}".format(e))
+
+
+class InferenceServer(object):
+    """
+    Evaluate the states from all workers in one forward pass.
+    Workers call infer() and block until the batch containing their state is done.
+    The batch is sent when MaxBatch states are collected or Window seconds passed.
+    """
+    def __init__(self, ppo, Coordinator, MaxBatch, Window=0.001):
+        self.ppo = ppo
+        self.Coordinator = Coordinator
+        self.MaxBatch = MaxBatch
+        self.Window = Window
+        self.Requests = queue.Queue()
+        # set when serve() returns, no request will be answered after that
+        self.Stopped = False
+
+    def infer(self, s, PassHistory):
+        """
+        return the chosen pass for a single state, see PPO.choose_action()
+        Raise RuntimeError if the server stopped before answering.
+        """
+        request = {'state': s, 'mask': PassHistory, 'result': None, 'done': threading.Event()}
+        self.Requests.put(request)
+        # the request may be put after serve() returned, do not wait for it forever
+        while not request['done'].wait(timeout=0.1):
+            if self.Stopped:
+                break
+        if request['result'] is None:
+            raise RuntimeError('InferenceServer stopped before answering')
+        return request['result']
+
+    def serve(self):
+        """
+        Answer the requests until the coordinator stops.
+        If evaluating a batch fails, the coordinator is stopped with the exception.
+        """
+        try:
+            with self.Coordinator.stop_on_exception():
+                self.serve_loop()
+        finally:
+            self.Stopped = True
+            # fail the pending requests, infer() raises for them
+            while True:
+                try:
+                    self.Requests.get_nowait()['done'].set()
+                except queue.Empty:
+                    break
+        hp.ColorPrint(Fore.YELLOW, 'InferenceServer stopped')
+
+    def serve_loop(self):
+        # called for every step of every worker, look up the attributes once
+        get = self.Requests.get
+        run = self.ppo.sess.run
+        sample_op, tfs, used_mask = self.ppo.sample_op, self.ppo.tfs, self.ppo.used_mask
+        MaxBatch, Window = self.MaxBatch, self.Window
+        while not self.Coordinator.should_stop():
+            try:
+                batch = [get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            # wait a little for the other workers
+            deadline = time.time() + Window
+            while len(batch) < MaxBatch:
+                remain = deadline - time.time()
+                if remain <= 0:
+                    break
+                try:
+                    batch.append(get(timeout=remain))
+                except queue.Empty:
+                    break
+            states = np.stack([request['state'] for request in batch])
+            masks = np.stack([request['mask'] for request in batch])
+            actions = run(sample_op, {tfs: states, used_mask: masks})
+            for request, action in zip(batch, actions):
+                request['result'] = action
+                request['done'].set()
@@ -5,23 +5,11 @@ tensorflow
 gym
 gym_OptClang
 """
-import tensorflow as tf
 import numpy as np
-import matplotlib
-# do not use x-server
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import gym, gym_OptClang
-import random, threading, queue, operator, os, sys, re
-from operator import itemgetter
-from random import shuffle
-import random
-from colorama import Fore, Style
+import threading, os
+from colorama import Fore
 from datetime import datetime
-from sklearn.preprocessing import StandardScaler
-import time
-import io
-from time import gmtime, strftime
 import argparse
 import pytz
 import PPPO
@@ -33,7 +21,7 @@ config = hp.LoadJsonConfig('./config.json')
 EP_MAX = config['WorkerParameters']['EP_MAX']
 # parallel workers
 N_WORKER = config['WorkerParameters']['N_WORKER']
-# minimum batch size for updating PPO
+# minimum batch size of each worker for updating PPO
 MIN_BATCH_SIZE = config['WorkerParameters']['MIN_BATCH_SIZE']
 # reward discount factor
 GAMMA = config['WorkerParameters']['GAMMA']
@@ -50,36 +38,60 @@ LR_DECAY = config['RL_Parameters']['LR_DECAY']
 LR_DECAY_FREQ = config['RL_Parameters']['LR_DECAY_FREQ']
 # learn multiple times. Because of the PPO will constrain the update speed.
 UpdateDepth = config['RL_Parameters']['UpdateDepth']
+# save the model for every SaveFreq updates
+SaveFreq = config['RL_Parameters']['SaveFreq']
 # number of L1 neurons
 L1Neurons = config['RL_Parameters']['L1Neurons']
 # number of L2 neurons
 L2Neurons = config['RL_Parameters']['L2Neurons']
+# float16 matmuls in the fully connected layers
+MixedPrecision = config['RL_Parameters']['MixedPrecision']
+# critic shares the hidden layers of actor
+SharedTrunk = config['RL_Parameters']['SharedTrunk']
+# normalization of hidden layers
+Normalization = config['RL_Parameters']['Normalization']
+# XLA JIT compilation
+UseXLA = config['RL_Parameters']['UseXLA']
 
 # Initialize the necessary vars
-SharedStorage = hp.InitSharedStorage()
+SharedStorage = hp.InitSharedStorage(N_WORKER)
 
 class Worker(object):
-    def __init__(self, WorkerID, SharedStorage, LogDir):
-        global GlobalPPO
+    def __init__(self, WorkerID, SharedStorage, LogDir, ppo):
         self.wid = WorkerID
         self.env = gym.make(Game).unwrapped
-        self.ppo = GlobalPPO
+        # all workers share the graph and session of the global PPO
+        self.ppo = ppo
         self.SharedStorage = SharedStorage
         self.LogDir = LogDir
+        # transitions which are not discounted yet
+        self.Buffer = hp.TransitionBuffer(self.ppo.S_DIM)
 
     def work(self):
+        """
+        Collect data until the coordinator stops.
+        If this worker fails, stop the training instead of leaving the others at the barrier.
+        """
+        try:
+            with self.SharedStorage['Coordinator'].stop_on_exception():
+                self.collect()
+        finally:
+            # wake up the threads waiting at the barrier
+            self.SharedStorage['Barrier'].abort()
+        hp.ColorPrint(Fore.YELLOW, 'WorkerID={} stopped'.format(self.wid))
+
+    def collect(self):
+        MeanSigmaDict = calc.getCpuMeanSigmaInfo()
         while not self.SharedStorage['Coordinator'].should_stop():
             states, ResetInfo = self.env.reset()
             EpisodeReward = 0
-            buffer_s, buffer_a, buffer_r = {}, {}, {}
-            MeanSigmaDict = calc.getCpuMeanSigmaInfo()
+            self.Buffer.clear()
+            BatchCount = 0
+            # perf name -> clang name of the functions in this target
+            NameMapDict = {}
             FirstEpi = True
-            PassHistory = {}
+            PassHistory = np.zeros(self.ppo.A_DIM, dtype=np.bool_)
             while True:
-                # while global PPO is updating
-                if not self.SharedStorage['Events']['collect'].is_set():
-                    # wait until PPO is updated
-                    self.SharedStorage['Events']['collect'].wait()
                 '''
                 Save the last profiled info to calculate real rewards
                 '''
@@ -110,7 +122,7 @@ class Worker(object):
                 '''
                 if reward < 0:
                     # clear history of applied passes
-                    PassHistory = {}
+                    PassHistory = np.zeros(self.ppo.A_DIM, dtype=np.bool_)
                     hp.ColorPrint(Fore.RED, 'WorkerID={} env.step() Failed. Use new target and forget these memories'.format(self.wid))
                     break
                 try:
@@ -120,7 +132,7 @@ class Worker(object):
                     '''
                     rewards, oldAllUsage = calc.calcEachReward(info,
                             MeanSigmaDict, nextStates, oldInfo,
-                            oldCycles, isUsageNotProcessed)
+                            oldCycles, isUsageNotProcessed, NameMapDict)
                     '''
                     Speedup for tf.summary
                     Skip this iteration, if the speedup/slowdown is not obvious
@@ -132,7 +144,7 @@ class Worker(object):
                         hp.ColorPrint(Fore.RED,
                                 "WorkerID={}, Speedup={} --> skip this iteration".format(self.wid, speedup))
                         if done:
-                            PassHistory = {}
+                            PassHistory = np.zeros(self.ppo.A_DIM, dtype=np.bool_)
                             break
                         else:
                             states = nextStates
@@ -142,7 +154,7 @@ class Worker(object):
                     Match the states and rewards
                     '''
                     AddedCount = calc.appendStateRewards(
-                            buffer_s, buffer_a, buffer_r, states, rewards, action)
+                            self.Buffer, states, rewards, action)
 
                     '''
                     Calculate overall reward for summary
@@ -153,55 +165,51 @@ class Worker(object):
                             "Exception for receiving uncompleted data\n{}".format(e))
                     if done:
                         # This may lose some data for training.
-                        PassHistory = {}
+                        PassHistory = np.zeros(self.ppo.A_DIM, dtype=np.bool_)
                         break
                     else:
                         states = nextStates
                         continue
 
                 # add the generated results
-                self.SharedStorage['Locks']['counter'].acquire()
-                self.SharedStorage['Counters']['update_counter'] = \
-                    self.SharedStorage['Counters']['update_counter'] + AddedCount
-                self.SharedStorage['Locks']['counter'].release()
-                if self.SharedStorage['Counters']['update_counter'] >= MIN_BATCH_SIZE or done:
+                BatchCount += AddedCount
+                # an episode may end without any valid data, wait until there is some
+                if BatchCount >= MIN_BATCH_SIZE or (done and BatchCount > 0):
                     '''
                     Calculate discounted rewards for all functions
                     '''
-                    discounted_r = calc.calcDiscountedRewards(buffer_r, nextStates, self.ppo)
+                    vstack_r = calc.calcDiscountedRewards(self.Buffer, nextStates, self.ppo)
                     '''
-                    Convert dict of list into row-array
+                    The rows in buffer are already row-arrays
                     '''
-                    vstack_s, vstack_a, vstack_r = calc.DictToVstack(buffer_s, buffer_a, discounted_r)
+                    vstack_s, vstack_a = self.Buffer.view()
                     '''
                     Remove data that are not important in the batch
                     '''
                     vstack_s, vstack_a, vstack_r, delCount = \
                             calc.RemoveTrivialData(vstack_s, vstack_a, vstack_r, AbandonRatio=20)
                     hp.ColorPrint(Fore.GREEN, "Throw away {} data in this batch".format(delCount))
-                    self.SharedStorage['Locks']['counter'].acquire()
-                    self.SharedStorage['Counters']['update_counter'] = \
-                        self.SharedStorage['Counters']['update_counter'] - delCount
-                    self.SharedStorage['Locks']['counter'].release()
                     '''
-                    Split each of vector and assemble into a queue element.
+                    Put the whole batch at once.
                     '''
-                    self.SharedStorage['Locks']['queue'].acquire()
-                    # put data in the shared queue
-                    for index, item in enumerate(vstack_s):
-                        self.SharedStorage['DataQueue'].put(
-                                np.hstack((vstack_s[index], vstack_a[index], vstack_r[index])))
-                    self.SharedStorage['Locks']['queue'].release()
-                    buffer_s, buffer_a, buffer_r = {}, {}, {}
+                    self.SharedStorage['DataBuffers'][self.wid - 1].put(vstack_s, vstack_a, vstack_r)
+                    self.Buffer.clear()
+                    BatchCount = 0
 
-                    # stop collecting data
-                    self.SharedStorage['Events']['collect'].clear()
-                    # globalPPO update
-                    self.SharedStorage['Events']['update'].set()
+                    try:
+                        # wait for the other workers, then globalPPO update
+                        self.SharedStorage['Barrier'].wait()
+                        # wait until PPO is updated
+                        self.SharedStorage['Barrier'].wait()
+                    except threading.BrokenBarrierError:
+                        # training is stopped by another worker
+                        break
 
                     if self.SharedStorage['Counters']['ep'] >= EP_MAX:
                         # stop training
                         self.SharedStorage['Coordinator'].request_stop()
+                        # wake up the threads waiting at the barrier
+                        self.SharedStorage['Barrier'].abort()
                         hp.ColorPrint(Fore.RED, 'WorkerID={} calls to Stop'.format(self.wid))
                         break
                 if not done:
@@ -209,7 +217,7 @@ class Worker(object):
                     continue
                 else:
                     # clear history of applied passes
-                    PassHistory = {}
+                    PassHistory = np.zeros(self.ppo.A_DIM, dtype=np.bool_)
                     # record reward changes, plot later
                     self.SharedStorage['Locks']['plot_epi'].acquire()
                     # add episode count
@@ -222,7 +230,6 @@ class Worker(object):
                     msg = '{0:}/{1:} ({2:.1f}%)'.format(self.SharedStorage['Counters']['ep'], EP_MAX,self.SharedStorage['Counters']['ep']/EP_MAX*100) + ' | WorkerID={}'.format(self.wid) + '\nEpisodeReward: {0:.4f}'.format(EpisodeReward) + ' | OverallSpeedup: {}'.format(speedup)
                     hp.ColorPrint(Fore.GREEN, msg)
                     break
-        hp.ColorPrint(Fore.YELLOW, 'WorkerID={} stopped'.format(self.wid))
 
 
 
@@ -261,7 +268,15 @@ if __name__ == '__main__':
             ClippingEpsilon=ClippingEpsilon,
             L1Neurons=L1Neurons,
             L2Neurons=L2Neurons,
-            UpdateDepth=UpdateDepth)
+            UpdateDepth=UpdateDepth,
+            MixedPrecision=MixedPrecision,
+            SharedTrunk=SharedTrunk,
+            Normalization=Normalization,
+            SaveFreq=SaveFreq,
+            UseXLA=UseXLA)
+    # batch the action inference of all workers
+    GlobalPPO.InferenceServer = PPPO.InferenceServer(GlobalPPO, SharedStorage['Coordinator'],
+            MaxBatch=N_WORKER)
     # remove worker file list.
     WorkerListLoc = "/tmp/gym-OptClang-WorkerList"
     if os.path.exists(WorkerListLoc):
@@ -269,13 +284,18 @@ if __name__ == '__main__':
 
     workers = []
     for i in range(N_WORKER):
-        workers.append(Worker(WorkerID=(i+1), SharedStorage=SharedStorage, LogDir=args['logdir']))
+        workers.append(Worker(WorkerID=(i+1), SharedStorage=SharedStorage, LogDir=args['logdir'],
+            ppo=GlobalPPO))
 
     threads = []
     for worker in workers:
         t = threading.Thread(target=worker.work, args=())
         t.start()
         threads.append(t)
+    # add a thread to serve the action inference
+    threads.append(threading.Thread(target=GlobalPPO.InferenceServer.serve,
+        args=()))
+    threads[-1].start()
     # add a PPO updating thread
     threads.append(threading.Thread(target=GlobalPPO.update,
         args=()))